@@ -5,7 +5,12 @@ import pandas as pd
 from sklearn.model_selection import train_test_split
 import os
 from os import path
-import torch
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pv
+except ImportError:
+    pa = None
 
 # organized as list so that it is easy to automatically iterate 
 # if you want to add other datasets, models, or embedding dimensions
@@ -32,12 +37,75 @@ setting_kgs = {
     '7': '7_cf_dbpedia_llm_u'
 }
 
+
+def load_triples(train_path, test_path):
+
+    # the factories are cached next to the .tsv files in pykeen's binary format,
+    # and rebuilt only when the .tsv files are newer than the cache
+    train_cache = f'{train_path}.tf'
+    test_cache = f'{test_path}.tf'
+
+    if os.path.exists(train_cache) and os.path.getmtime(train_cache) >= os.path.getmtime(train_path) and \
+            os.path.exists(test_cache) and os.path.getmtime(test_cache) >= os.path.getmtime(test_path):
+        return TriplesFactory.from_path_binary(train_cache), TriplesFactory.from_path_binary(test_cache)
+
+    emb_training = TriplesFactory.from_path(
+        train_path,
+        create_inverse_triples=True,
+    )
+
+    emb_testing = TriplesFactory.from_path(
+        test_path,
+        entity_to_id=emb_training.entity_to_id,
+        relation_to_id=emb_training.relation_to_id,
+        create_inverse_triples=True,
+    )
+
+    emb_training.to_path_binary(train_cache)
+    emb_testing.to_path_binary(test_cache)
+
+    # overwriting the files inside an existing cache does not update the directory mtime,
+    # which is what the freshness check above looks at
+    os.utime(train_cache)
+    os.utime(test_cache)
+
+    return emb_training, emb_testing
+
+
+def save_embeddings(embeddings, outfile):
+
+    # pyarrow writes the embedding matrix column by column with its multi-threaded writer,
+    # numpy is used when it is not installed (9 significant digits round-trip a float32)
+    if pa is None:
+        np.savetxt(outfile, embeddings, fmt='%.9g', delimiter='\t')
+        return
+
+    table = pa.Table.from_arrays([pa.array(np.ascontiguousarray(col)) for col in embeddings.T],
+                                 names=[str(i) for i in range(embeddings.shape[1])])
+    pv.write_csv(table, outfile, write_options=pv.WriteOptions(include_header=False, delimiter='\t'))
+
+
 log_file = open('log.txt', 'w')
 
-for emb_model in emb_models:
-    for emb_dim in emb_dims:
-        for dataset in datasets:
-            for setting in settings:
+for dataset in datasets:
+    for setting in settings:
+
+        train_path = f'{dataset}/setting_{setting_kgs[setting]}/pykeen_train.tsv'
+        test_path = f'{dataset}/setting_{setting_kgs[setting]}/pykeen_test.tsv'
+
+        # the triples only depend on dataset and setting, so load them once
+        # for all the models, dimensions and number of layers
+        try:
+            emb_training, emb_testing = load_triples(train_path, test_path)
+        except Exception as e:
+            print('An error occoured loading ' + train_path)
+            log_file.write('An error occoured loading ' + train_path + '\n')
+            print(e)
+            log_file.write(str(e)+'\n')
+            continue
+
+        for emb_model in emb_models:
+            for emb_dim in emb_dims:
                 for n_layer in n_layers:
 
                     printline = f'{dataset}_setting_{setting}_{emb_model}_k={str(emb_dim)}_l={str(n_layer)}'
@@ -46,9 +114,6 @@ for emb_model in emb_models:
                     
                     folder = f'results/{dataset}_setting_{setting}_{emb_model}_k={str(emb_dim)}_l={str(n_layer)}'
 
-                    train_path = f'{dataset}/setting_{setting_kgs[setting]}/pykeen_train.tsv'
-                    test_path = f'{dataset}/setting_{setting_kgs[setting]}/pykeen_test.tsv'
-
                     checkpoint_name_file = f'{dataset}_checkpoints_setting_{setting}_{emb_model}_k={str(emb_dim)}_l={str(n_layer)}'
 
                     # if embs already exists, skip
@@ -61,19 +126,6 @@ for emb_model in emb_models:
 
                         print('Starting learning:' + folder)
                         print("Starting learning:", printline)
-                        
-
-                        emb_training = TriplesFactory.from_path(
-                            train_path,
-                            create_inverse_triples=True,
-                        )
-
-                        emb_testing = TriplesFactory.from_path(
-                            test_path,
-                            entity_to_id=emb_training.entity_to_id,
-                            relation_to_id=emb_training.relation_to_id,
-                            create_inverse_triples=True,
-                        )
 
                         result = pipeline(
                             training=emb_training,
@@ -95,22 +147,19 @@ for emb_model in emb_models:
                         if not os.path.exists(folder):
                             os.mkdir(folder)
 
-
-                        torch.save(result, folder+'/pipeline_result.dat')
-
                         map_ent = pd.DataFrame(data=list(emb_training.entity_to_id.items()))
                         map_ent.to_csv(folder+'/entities_to_id.tsv', sep='\t', header=False, index=False)
                         map_ent = pd.DataFrame(data=list(emb_training.relation_to_id.items()))
                         map_ent.to_csv(folder+'/relations_to_id.tsv', sep='\t', header=False, index=False)
 
 
-                        # save mappings
+                        # save model, training triples and metadata (results.json also holds the losses and metrics)
                         result.save_to_directory(folder, save_training=True, save_metadata=True)
 
                         # extract embeddings with gpu
                         entity_embedding_tensor = result.model.entity_representations[0](indices = None)
                         # save entity embeddings to a .tsv file (gpu)
-                        df = pd.DataFrame(data=entity_embedding_tensor.cpu().data.numpy())
+                        embeddings = entity_embedding_tensor.detach().cpu().numpy()
 
                         # extract embeddings with cpu
                         #entity_embedding_tensor = result.model.entity_representations[0](indices=None).detach().numpy()
@@ -118,7 +167,7 @@ for emb_model in emb_models:
                         #df = pd.DataFrame(data=entity_embedding_tensor.astype(float))
 
                         outfile = folder + '/embeddings.tsv'
-                        df.to_csv(outfile, sep='\t', header=False, index=False)
+                        save_embeddings(embeddings, outfile)
 
                         print('Completed ' + printline)
                         log_file.write('Completed\n')
@@ -37,8 +37,9 @@ class RecSysNetwork(torch.nn.Module):
 
     def return_scores(self, user_idx, item_idx):
         with torch.no_grad():
-            scores = self((torch.from_numpy(user_idx).int(),
-                           torch.from_numpy(item_idx).int())).cpu()
+            # the networks output logits, the sigmoid is only applied to get the scores
+            scores = torch.sigmoid(self((torch.from_numpy(user_idx).int(),
+                                         torch.from_numpy(item_idx).int()))).cpu()
 
             if len(item_idx) != 1:
                 return scores.squeeze()
@@ -105,8 +106,7 @@ class RecSysNetworkBasic(SingleSourceRecSysNetwork):
             nn.ReLU(),
             nn.Linear(16, 8),
             nn.ReLU(),
-            nn.Linear(8, 1),
-            nn.Sigmoid()
+            nn.Linear(8, 1)
         )
 
         self.init_()
@@ -143,8 +143,7 @@ class RecSysNetworkBasicAllItems(SingleSourceRecSysNetwork):
             nn.ReLU(),
             nn.Linear(16, 8),
             nn.ReLU(),
-            nn.Linear(8, 1),
-            nn.Sigmoid()
+            nn.Linear(8, 1)
         )
 
         self.init_()
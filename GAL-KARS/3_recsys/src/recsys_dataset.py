@@ -1,28 +1,65 @@
 from __future__ import annotations
 
+import os
 import torch
 import numpy as np
 import torch.nn as nn
-import torch.utils.data as data
 import math
 
 import pandas as pd
 
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pv
+except ImportError:
+    pa = None
 
-class RecSysDataset(data.Dataset):
-    def __init__(self, train_ratings: pd.DataFrame):
 
-        self.train_ratings_users = np.array(train_ratings['user'])
-        self.train_ratings_items = np.array(train_ratings['item'])
-        self.train_ratings_scores = np.array(train_ratings['score'])
+def load_ratings(path: str) -> pd.DataFrame:
 
-    def __len__(self):
-        return self.train_ratings_users.shape[0]
+    # a parquet copy of the ratings is stored next to the .tsv file and used
+    # as long as it is newer than the .tsv it was built from
+    cache_path = os.path.splitext(path)[0] + '.parquet'
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        # an unreadable cache (no parquet engine, corrupt file) falls back to the .tsv
+        try:
+            return pd.read_parquet(cache_path)
+        except (ImportError, OSError, ValueError):
+            pass
 
-    def __getitem__(self, idx):
+    ratings = pd.read_csv(path, sep='\t', names=['user', 'item', 'score'],
+                          dtype={'user': 'int64', 'item': 'int64', 'score': 'float32'}, engine='c')
 
-        user_idx = self.train_ratings_users[idx]
-        item_idx = self.train_ratings_items[idx]
-        rating = self.train_ratings_scores[idx]
+    # parquet needs pyarrow (or fastparquet), without it, or if the data folder
+    # is not writable, the cache is simply skipped
+    try:
+        ratings.to_parquet(cache_path, index=False)
+    except (ImportError, OSError):
+        pass
 
-        return user_idx, item_idx, rating
\ No newline at end of file
+    return ratings
+
+
+def map_to_indices(keys: np.ndarray, values: np.ndarray) -> np.ndarray:
+
+    # keys are sorted, so the index of an id is its position in the key array;
+    # ids that are not among the keys would silently land on a neighbouring index
+    pos = np.searchsorted(keys, values)
+    found = keys[np.minimum(pos, len(keys) - 1)] == values
+    if not found.all():
+        missing = np.unique(values[~found])
+        raise ValueError(f'{len(missing)} ids have no embedding, e.g. {missing[:10].tolist()}')
+
+    return pos.astype(np.int32)
+
+
+def save_tsv(df: pd.DataFrame, path: str) -> None:
+
+    # pyarrow writes the (numeric) frames with its multi-threaded writer,
+    # pandas is used when it is not installed
+    if pa is None:
+        df.to_csv(path, sep='\t', header=False, index=False)
+        return
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pv.write_csv(table, path, write_options=pv.WriteOptions(include_header=False, delimiter='\t'))
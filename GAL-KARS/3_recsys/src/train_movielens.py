@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import os
+import argparse
 import torch
 
 import numpy as np
@@ -12,13 +13,11 @@ import random
 from tqdm import tqdm
 from typing import Type
 from torch.optim import Adam, SGD
-from torch.utils.data import DataLoader
 
 from termcolor import colored
-import sys
 import time
 
-from recsys_dataset import RecSysDataset
+from recsys_dataset import load_ratings, map_to_indices, save_tsv
 from recsys_basic import RecSysNetwork, RecSysNetworkBasic
 
 THIS_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -30,61 +29,77 @@ REPORTS_DIR = os.path.join(ROOT_DIR, 'reports')
 RAW_DATA_DIR = os.path.join(DATA_DIR, 'raw')
 
 
-def set_seed(seed: int = 42) -> None:
+def set_seed(seed: int = 42, deterministic: bool = False) -> None:
     np.random.seed(seed)
     random.seed(seed)
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
-    # When running on the CuDNN backend, two further options must be set
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
+    # When running on the CuDNN backend, deterministic algorithms are only forced if requested,
+    # otherwise the autotuner picks the fastest ones (batch shapes are fixed)
+    torch.backends.cudnn.deterministic = deterministic
+    torch.backends.cudnn.benchmark = not deterministic
     # Set a fixed value for the hash seed
     os.environ["PYTHONHASHSEED"] = str(seed)
     print(f"Random seed set as {seed}")
 
 
 def train(train_ratings: pd.DataFrame, batch_size: int, epochs: int, device: str, model_class: Type[RecSysNetwork],
-           modality_features: np.array, weights: list, dropout_value: float):
+           modality_features: np.array, weights: list, dropout_value: float, lr: float = 1e-3):
 
-    train_ds = RecSysDataset(train_ratings)
-    train_dl = DataLoader(train_ds, shuffle=True, batch_size=batch_size)
+    # keep the whole ratings table on the device and slice batches out of it,
+    # instead of collating one (user, item, score) row at a time
+    users = torch.as_tensor(train_ratings['user'].values, dtype=torch.int32, device=device)
+    items = torch.as_tensor(train_ratings['item'].values, dtype=torch.int32, device=device)
+    scores = torch.as_tensor(train_ratings['score'].values, dtype=torch.float32, device=device)
+    n_ratings = users.shape[0]
 
     # init the corresponding RecSys network using item and user features
     model = model_class(
         modality_features = modality_features,
         dropout_value = dropout_value
-    ).to(device)
+    ).to(device, non_blocking=True)
 
     if weights is not None:
         model = model.import_weights(weights)
 
-    optimizer = Adam(model.parameters())
+    # a single fused kernel updates all the parameters on cuda,
+    # falling back to the multi-tensor implementation where fused is not available
+    try:
+        optimizer = Adam(model.parameters(), lr=lr, fused=device.startswith('cuda'))
+    except (TypeError, RuntimeError):
+        optimizer = Adam(model.parameters(), lr=lr, foreach=device.startswith('cuda'))
     # optimizer = SGD(model.parameters(), lr=0.001)
 
+    # forward and loss run in bf16 where supported, which needs no gradient scaling;
+    # the parameters and the optimizer state stay in fp32
+    device_type = torch.device(device).type
+    use_bf16 = device_type == 'cuda' and torch.cuda.is_bf16_supported()
+
     print(colored('Training set with model '+str(type(model))+' and '+str(len(modality_features))+' features', 'green'))
 
     for epoch in range(epochs):
 
         train_loss = 0
-        tqdm_bar = tqdm(train_dl)
+        perm = torch.randperm(n_ratings, device=device)
+        tqdm_bar = tqdm(range(0, n_ratings, batch_size))
 
-        for i, batch in enumerate(tqdm_bar):
+        for i, start in enumerate(tqdm_bar):
 
             optimizer.zero_grad()
 
-            user_idx = batch[0].int()
-            item_idx = batch[1].int()
+            idx = perm[start:start + batch_size]
 
             # model input is a tuple (user, item) idxs where the idx refers to the embedding stored
             # inside the first parameters of the network (item_features and user_features)
             model_input = (
-                user_idx,
-                item_idx,
+                users[idx],
+                items[idx],
                 dropout_value
             )
 
-            score = model(model_input)
-            loss = fun.binary_cross_entropy(score.flatten().to(device), batch[2].to(device).float())
+            with torch.autocast(device_type, dtype=torch.bfloat16, enabled=use_bf16):
+                score = model(model_input)
+                loss = fun.binary_cross_entropy_with_logits(score.flatten(), scores[idx])
 
             train_loss += loss.item()
 
@@ -101,62 +116,76 @@ def train(train_ratings: pd.DataFrame, batch_size: int, epochs: int, device: str
     return model
 
 
-@torch.no_grad()
-def test(model: RecSysNetwork, test_ratings: pd.DataFrame, batch_size: int, device: str, dropout_value: float):
+def test(model: RecSysNetwork, test_ratings: pd.DataFrame, batch_size: int, device: str, dropout_value: float,
+         k: int = 10):
 
     model.to(device)
 
-    test_ds = RecSysDataset(test_ratings)
-    test_dl = DataLoader(test_ds, shuffle=False, batch_size=batch_size)
-    tqdm_bar = tqdm(test_dl)
+    users = torch.as_tensor(test_ratings['user'].values, dtype=torch.int32, device=device)
+    items = torch.as_tensor(test_ratings['item'].values, dtype=torch.int32, device=device)
+    n_ratings = users.shape[0]
+    tqdm_bar = tqdm(range(0, n_ratings, batch_size))
+
+    # scores are written in place on the device and copied back once at the end;
+    # the fp16 logits are cast to fp32 before the sigmoid, since fp16 scores near 1
+    # collapse into ties and would decide the ranking by tie order
+    scores = torch.empty(n_ratings, dtype=torch.float32, device=device)
 
-    user_idxs = []
-    item_idxs = []
-    scores = []
+    device_type = torch.device(device).type
+    with torch.inference_mode():
 
-    for i, batch in enumerate(tqdm_bar):
+        for i, start in enumerate(tqdm_bar):
+
+            user_idx = users[start:start + batch_size]
+            item_idx = items[start:start + batch_size]
+
+            model_input = (
+                user_idx,
+                item_idx,
+                dropout_value
+            )
 
-        user_idx = batch[0].int()
-        item_idx = batch[1].int()
+            # only the network runs in fp16, the sigmoid is applied to the fp32 logits
+            with torch.autocast(device_type, dtype=torch.float16, enabled=device_type == 'cuda'):
+                logits = model(model_input)
 
-        model_input = (
-            user_idx,
-            item_idx,
-            dropout_value
-        )
+            score = torch.sigmoid(logits.float())
 
-        score = model(model_input)
+            scores[start:start + batch_size] = score.flatten()
 
-        user_idxs.append(user_idx)
-        item_idxs.append(item_idx)
-        scores.append(score.squeeze())
+    # keep only the top k items of each user on the device: order by score, then stably by user,
+    # so that each user's ratings form a block sorted by descending score
+    order = torch.argsort(scores, descending=True)
+    order = order[torch.argsort(users[order], stable=True)]
+    sorted_users = users[order]
 
-    user_idxs = torch.hstack(user_idxs).int().numpy()
-    item_idxs = torch.hstack(item_idxs).int().numpy()
-    scores = torch.hstack(scores).float().cpu().numpy()
+    # position of each rating inside its user's block
+    rank = torch.arange(n_ratings, device=device) - torch.searchsorted(sorted_users, sorted_users)
+    top_k = order[rank < k]
 
     # create the DataFrame where each row is (user, item, score)
-    predictions = pd.DataFrame.from_records(
-        zip(user_idxs, item_idxs, scores),
-        columns=['user', 'item', 'score'],
-        index=None
-    )
+    predictions = pd.DataFrame({
+        'user': users[top_k].cpu().numpy(),
+        'item': items[top_k].cpu().numpy(),
+        'score': scores[top_k].cpu().numpy()
+    }, copy=False)
 
-    predictions = predictions.sort_values(by=['user', 'score'], ascending=[True, False])
-    
     return predictions
 
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--deterministic', action='store_true',
+                        help='use deterministic CuDNN algorithms, for reproducibility runs')
+    args = parser.parse_args()
+
     RecSys_network_class = RecSysNetworkBasic
     
-    train_ratings = pd.read_table(os.path.join(RAW_DATA_DIR, 'ml1m', 'train.tsv'),
-                                  names = ['user', 'item', 'score'], sep='\t')
+    train_ratings = load_ratings(os.path.join(RAW_DATA_DIR, 'ml1m', 'train.tsv'))
     print(f'New train len {len(train_ratings)}')
 
-    test_ratings = pd.read_table(os.path.join(RAW_DATA_DIR, 'ml1m', 'test.tsv'),
-                                  names = ['user', 'item', 'score'], sep='\t')
+    test_ratings = load_ratings(os.path.join(RAW_DATA_DIR, 'ml1m', 'test.tsv'))
     print(f'New test len {len(test_ratings)}')
 
     # get unique users and map them to indices (0, 1, 2, ...)
@@ -172,32 +201,39 @@ if __name__ == "__main__":
 
     tensors_dict = dict()
     total_size = 0
+    # all the embeddings are for the same entities (9117), so the sorted key
+    # order is computed on the first file and reused for the others
+    key_order = None
     for folder in emb_folders:
         embs = [os.path.join(folder, x) for x in os.listdir(folder)]
         for emb in embs:
             if '.pkl' in emb:
                 with open(emb, 'rb') as f:
                     emb_features = pkl.load(f)
-                    emb_features = dict(sorted(emb_features.items()))
-                    emb_features_tensor = torch.from_numpy(np.stack(list(emb_features.values())))
-                    total_size += sys.getsizeof(emb_features_tensor)
+                    if key_order is None:
+                        key_order = sorted(emb_features.keys())
+                    # stored once as fp32 so that the network wraps it without another copy,
+                    # and pinned so that moving it to the gpu is an async transfer
+                    emb_features_tensor = torch.from_numpy(
+                        np.stack([emb_features[k] for k in key_order]).astype(np.float32, copy=False))
+                    if torch.cuda.is_available():
+                        emb_features_tensor = emb_features_tensor.pin_memory()
+                    total_size += emb_features_tensor.numel() * emb_features_tensor.element_size()
                     name_model = emb.split('/')[-1].replace('.pkl','')
                     tensors_dict[name_model] = emb_features_tensor
 
-    print(colored('Embeddings loaded. Total size: ' + str(total_size), 'blue'))
+    print(colored('Embeddings loaded. Total size: ' + str(total_size) + ' bytes', 'blue'))
 
-    # get any source and produce the mapping - we choose the graph, but it is the same
-    # due to the fact that the embeddings are always for the same entities (9117)
-    # and we are sorting the keys
-    source_features = dict(sorted((pkl.load(open('data/embeddings/ml1m/ml1m_s=1_CompGCN_k=64_l=1.pkl', 'rb'))).items()))
-    source_mapping_indeces = np.arange(0, len(source_features))
-    source_mapping = dict(zip(source_features.keys(), source_mapping_indeces))
+    # the mapping is the same for every source, since the embeddings are always
+    # for the same entities and the keys are sorted: the index of an id is
+    # its position in the key array
+    source_keys = np.array(key_order)
 
     # apply the mapping to the train and test ratings
-    train_ratings['user'] = train_ratings['user'].map(source_mapping)
-    train_ratings['item'] = train_ratings['item'].map(source_mapping)
-    test_ratings['user'] = test_ratings['user'].map(source_mapping)
-    test_ratings['item'] = test_ratings['item'].map(source_mapping)
+    train_ratings['user'] = map_to_indices(source_keys, train_ratings['user'].values)
+    train_ratings['item'] = map_to_indices(source_keys, train_ratings['item'].values)
+    test_ratings['user'] = map_to_indices(source_keys, test_ratings['user'].values)
+    test_ratings['item'] = map_to_indices(source_keys, test_ratings['item'].values)
 
 
     feature_list = [ 
@@ -239,7 +275,7 @@ if __name__ == "__main__":
             print(i, config)
 
             # set seed at each iteration
-            set_seed(42)
+            set_seed(42, deterministic=args.deterministic)
 
             features = [tensors_dict[model] for model in config]
             RecSys_model = RecSys_models[0]
@@ -273,8 +309,10 @@ if __name__ == "__main__":
 
             # set some hyperparameters
             epochs = 30
-            train_batch_size = 512
-            test_batch_size = 512
+            train_batch_size = 4096
+            # learning rate scaled linearly from the Adam default at batch size 512
+            learning_rate = 1e-3 * train_batch_size / 512
+            test_batch_size = 8192
             dropout_value = dropout_values[0]
 
             force = True
@@ -297,7 +335,7 @@ if __name__ == "__main__":
 
                 # train the model
                 trained_model = train(train_ratings, train_batch_size, epochs, device, 
-                    RecSys_model, features, weights=None, dropout_value = dropout_value)
+                    RecSys_model, features, weights=None, dropout_value = dropout_value, lr = learning_rate)
                 
                 # save the model
                 torch.save(trained_model, model_name)
@@ -305,22 +343,19 @@ if __name__ == "__main__":
 
             # start testing the model
             print(colored('Testing the model:', 'blue'))
-            predictions = test(trained_model, test_ratings, test_batch_size, device, dropout_value = dropout_value)
+            predictions = test(trained_model, test_ratings, test_batch_size, device, dropout_value = dropout_value, k=10)
 
             # remap user and items to original ids
-            list_mapping = list(source_features)
-            predictions['user'] = predictions['user'].map(lambda x: list_mapping[x])
-            predictions['item'] = predictions['item'].map(lambda x: list_mapping[x])
-
-            # Group the dataframe by user_id so that applying the .head function will return the first results
-            # for each user
-            grouped_predictions = predictions.groupby('user', as_index=False)
+            predictions['user'] = source_keys[predictions['user'].to_numpy()]
+            predictions['item'] = source_keys[predictions['item'].to_numpy()]
 
-            top5 = grouped_predictions.head(5)
-            top10 = grouped_predictions.head(10)
+            # the predictions already hold the top 10 items of each user, sorted by score;
+            # grouping by user_id, the .head function returns the first 5 of them
+            top5 = predictions.groupby('user', as_index=False).head(5)
+            top10 = predictions
             
-            top5.to_csv(preds_file_t5, sep='\t', index=False, header=None)
-            top10.to_csv(preds_file_t10, sep='\t', index=False, header=None)
+            save_tsv(top5, preds_file_t5)
+            save_tsv(top10, preds_file_t10)
             # top10.to_csv('predictions/'+setting_name+'_top10.pth', sep='\t', index=False)
             
             print(colored('Finished!', 'blue'))